@@ -1,19 +1,24 @@
 package main
 
 import (
-	"encoding/csv"
+	"bufio"
+	"bytes"
+	"context"
 	"encoding/json"
+	"errors"
 	"flag"
 	"fmt"
+	"io"
 	"net/http"
 	"os"
 	"path/filepath"
 	"runtime"
 	"strings"
 	"time"
+	"unicode/utf8"
 )
 
-// IPRecord представляет строку данных для сохранения
+// IPRecord представляет строку данных лога
 type IPRecord struct {
 	Timestamp string
 	IP        string
@@ -21,6 +26,11 @@ type IPRecord struct {
 	Comment   string
 }
 
+// fields возвращает поля записи в порядке колонок лога
+func (r IPRecord) fields() [len(logHeaders)]string {
+	return [...]string{r.Timestamp, r.IP, r.ISP, r.Comment}
+}
+
 // Config описывает структуру JSON-конфигурации
 type Config struct {
 	Storage struct {
@@ -122,9 +132,8 @@ func getLogPath(cfg *Config) string {
 		return filepath.Join(docsPath, logFilename)
 	}
 
-	fallbackDir := filepath.Join(home, ".ipwatch")
-	_ = os.MkdirAll(fallbackDir, 0755)
-	return filepath.Join(fallbackDir, logFilename)
+	// Саму папку создаём только при первом сохранении в лог
+	return filepath.Join(home, ".ipwatch", logFilename)
 }
 
 func normalizeISP(name string, rules map[string]string) string {
@@ -138,44 +147,77 @@ func normalizeISP(name string, rules map[string]string) string {
 }
 
 // Сетевые запросы
-func fetchURL(url string, timeout time.Duration) (map[string]interface{}, error) {
-	client := http.Client{Timeout: timeout}
-	resp, err := client.Get(url)
+
+// httpClient общий для всех запросов, чтобы соединения из пула транспорта
+// (keep-alive) переиспользовались между обращениями к провайдерам
+var httpClient = &http.Client{}
+
+// providerResponse — поля ответа провайдеров, из которых берутся IP и ISP.
+// Разные провайдеры называют их по-разному, лишние поля игнорируются.
+type providerResponse struct {
+	IP      string `json:"ip"`
+	Query   string `json:"query"`
+	Address string `json:"address"`
+	ISP     string `json:"isp"`
+	Org     string `json:"org"`
+}
+
+// ipInfo — итоговые IP и ISP, полученные от провайдера или заданные вручную
+type ipInfo struct {
+	IP  string
+	ISP string
+}
+
+// firstNonEmpty возвращает первое непустое значение
+func firstNonEmpty(values ...string) string {
+	for _, v := range values {
+		if v != "" {
+			return v
+		}
+	}
+	return ""
+}
+
+func fetchURL(url string, timeout time.Duration) (providerResponse, error) {
+	var data providerResponse
+
+	ctx, cancel := context.WithTimeout(context.Background(), timeout)
+	defer cancel()
+
+	req, err := http.NewRequestWithContext(ctx, http.MethodGet, url, nil)
+	if err != nil {
+		return data, err
+	}
+	resp, err := httpClient.Do(req)
 	if err != nil {
-		return nil, err
+		return data, err
 	}
 	defer resp.Body.Close()
 
-	var data map[string]interface{}
 	if err := json.NewDecoder(resp.Body).Decode(&data); err != nil {
-		return nil, err
+		return data, err
 	}
+	// Дочитываем тело до конца: иначе соединение не вернётся в пул
+	_, _ = io.Copy(io.Discard, resp.Body)
 	return data, nil
 }
 
-func fetchIPFast() (map[string]interface{}, error) {
+func fetchIPFast() (ipInfo, error) {
 	providers := []string{
 		"https://api.ipify.org?format=json",
 		"https://ifconfig.me/all.json",
 	}
 	for _, url := range providers {
 		if data, err := fetchURL(url, 2*time.Second); err == nil {
-			ip, _ := data["ip"].(string)
-			if ip == "" {
-				ip, _ = data["query"].(string)
-			}
-			if ip == "" {
-				ip, _ = data["address"].(string)
-			}
-			if ip != "" {
-				return map[string]interface{}{"query": ip, "isp": "N/A"}, nil
+			if ip := firstNonEmpty(data.IP, data.Query, data.Address); ip != "" {
+				return ipInfo{IP: ip, ISP: "N/A"}, nil
 			}
 		}
 	}
-	return nil, fmt.Errorf("all fast IP providers failed")
+	return ipInfo{}, fmt.Errorf("all fast IP providers failed")
 }
 
-func fetchIPFull() (map[string]interface{}, error) {
+func fetchIPFull() (ipInfo, error) {
 	providers := []string{
 		"http://ip-api.com/json/?fields=query,isp",
 		"https://ipinfo.io/json",
@@ -183,31 +225,17 @@ func fetchIPFull() (map[string]interface{}, error) {
 	}
 	for _, url := range providers {
 		if data, err := fetchURL(url, 3*time.Second); err == nil {
-			ip, _ := data["query"].(string)
-			if ip == "" {
-				ip, _ = data["ip"].(string)
-			}
-			if ip == "" {
-				ip, _ = data["address"].(string)
-			}
-
-			isp, _ := data["isp"].(string)
-			if isp == "" {
-				isp, _ = data["org"].(string)
-			}
-			if isp == "" {
-				isp = "N/A"
-			}
-
+			ip := firstNonEmpty(data.Query, data.IP, data.Address)
+			isp := firstNonEmpty(data.ISP, data.Org, "N/A")
 			if ip != "" {
-				return map[string]interface{}{"query": ip, "isp": isp}, nil
+				return ipInfo{IP: ip, ISP: isp}, nil
 			}
 		}
 	}
-	return nil, fmt.Errorf("all full IP providers failed")
+	return ipInfo{}, fmt.Errorf("all full IP providers failed")
 }
 
-func fetchIPForCustom(ip string) map[string]interface{} {
+func fetchIPForCustom(ip string) ipInfo {
 	providers := []string{
 		fmt.Sprintf("http://ip-api.com/json/%s?fields=query,isp", ip),
 		fmt.Sprintf("https://ipinfo.io/%s/json", ip),
@@ -215,68 +243,544 @@ func fetchIPForCustom(ip string) map[string]interface{} {
 	}
 	for _, url := range providers {
 		if data, err := fetchURL(url, 3*time.Second); err == nil {
-			foundIP, _ := data["query"].(string)
-			if foundIP == "" {
-				foundIP, _ = data["ip"].(string)
+			foundIP := firstNonEmpty(data.Query, data.IP)
+			isp := firstNonEmpty(data.ISP, data.Org, "N/A")
+			if foundIP != "" {
+				return ipInfo{IP: foundIP, ISP: isp}
 			}
-			isp, _ := data["isp"].(string)
-			if isp == "" {
-				isp, _ = data["org"].(string)
+		}
+	}
+	return ipInfo{IP: ip, ISP: "N/A"}
+}
+
+// logFieldReplacer убирает из полей символы, ломающие формат строки лога
+var logFieldReplacer = strings.NewReplacer("\t", " ", "\r", " ", "\n", " ")
+
+// formatLogLine собирает строку лога: поля через табуляцию, без экранирования.
+// Поле, начинающееся с кавычки, берётся в кавычки, как это делал encoding/csv.
+func formatLogLine(fields ...string) string {
+	var sb strings.Builder
+	for i, v := range fields {
+		if i > 0 {
+			sb.WriteByte('\t')
+		}
+		v = logFieldReplacer.Replace(v)
+		if strings.HasPrefix(v, `"`) {
+			v = `"` + strings.ReplaceAll(v, `"`, `""`) + `"`
+		}
+		sb.WriteString(v)
+	}
+	sb.WriteByte('\n')
+	return sb.String()
+}
+
+// cutLogField отрезает первое поле записи и сообщает, есть ли за ним ещё поля.
+// Поле в кавычках (так их писал encoding/csv в старых логах) может содержать
+// табуляции и переводы строк, "" внутри него — это кавычка. Поле с
+// незакрытой кавычкой возвращается как есть.
+func cutLogField(rec string) (field, rest string, more bool) {
+	if !strings.HasPrefix(rec, `"`) {
+		if tab := strings.IndexByte(rec, '\t'); tab >= 0 {
+			return rec[:tab], rec[tab+1:], true
+		}
+		return rec, "", false
+	}
+
+	var sb strings.Builder
+	i := 1
+	for {
+		j := strings.IndexByte(rec[i:], '"')
+		if j < 0 {
+			return rec, "", false
+		}
+		sb.WriteString(rec[i : i+j])
+		i += j + 1
+		if i < len(rec) && rec[i] == '"' {
+			sb.WriteByte('"')
+			i++
+			continue
+		}
+		break
+	}
+	if rec = rec[i:]; strings.HasPrefix(rec, "\t") {
+		return sb.String(), rec[1:], true
+	}
+	return sb.String(), "", false
+}
+
+// parseLogLine разбирает запись лога. Поля без кавычек нарезаются из самой
+// строки, без промежуточного слайса; поля в кавычках раскавычиваются.
+// Для неполных записей возвращает false.
+func parseLogLine(line string) (IPRecord, bool) {
+	line = strings.TrimSuffix(line, "\r")
+	var f [len(logHeaders)]string
+	last := len(f) - 1
+	for i := 0; i < last; i++ {
+		var more bool
+		if f[i], line, more = cutLogField(line); !more {
+			return IPRecord{}, false
+		}
+	}
+	// Последнее поле без кавычек забирает остаток строки целиком
+	f[last] = line
+	if strings.HasPrefix(line, `"`) {
+		f[last], _, _ = cutLogField(line)
+	}
+	return IPRecord{Timestamp: f[0], IP: f[1], ISP: f[2], Comment: f[3]}, true
+}
+
+// hasOpenQuote сообщает, осталось ли в записи незакрытое поле в кавычках,
+// то есть продолжается ли она на следующей строке
+func hasOpenQuote(rec []byte) bool {
+	if bytes.IndexByte(rec, '"') < 0 {
+		return false
+	}
+	inQuote, fieldStart := false, true
+	for i := 0; i < len(rec); i++ {
+		c := rec[i]
+		switch {
+		case inQuote:
+			if c == '"' {
+				if i+1 < len(rec) && rec[i+1] == '"' {
+					i++
+				} else {
+					inQuote = false
+				}
 			}
-			if isp == "" {
-				isp = "N/A"
+			continue
+		case fieldStart && c == '"':
+			inQuote, fieldStart = true, false
+			continue
+		}
+		fieldStart = c == '\t'
+	}
+	return inQuote
+}
+
+// isRecordStart проверяет, начинается ли строка с отметки времени записи
+// ("2006-01-02 15:04" и табуляция)
+func isRecordStart(line []byte) bool {
+	const layout = "0000-00-00 00:00\t"
+	if len(line) < len(layout) {
+		return false
+	}
+	for i := 0; i < len(layout); i++ {
+		if layout[i] == '0' {
+			if line[i] < '0' || line[i] > '9' {
+				return false
 			}
-			if foundIP != "" {
-				return map[string]interface{}{"query": foundIP, "isp": isp}
+		} else if line[i] != layout[i] {
+			return false
+		}
+	}
+	return true
+}
+
+// maxLogLine — предельная длина строки лога. Комментарий (-c) может быть
+// сколь угодно длинным, поэтому предел намного больше 64 КиБ по умолчанию
+// у bufio.Scanner; строка длиннее даёт ошибку чтения, а не пропуск записей.
+const maxLogLine = 16 * 1024 * 1024
+
+// logScanner читает лог по записям. Обычно запись — одна строка, но в старых
+// логах encoding/csv сохранял комментарий с переводом строки как поле в
+// кавычках на несколько строк; такие строки склеиваются в одну запись.
+type logScanner struct {
+	lines   *bufio.Scanner
+	record  []byte
+	buf     []byte
+	pending []byte
+}
+
+// newLogScanner возвращает сканер записей лога, уже пропустивший заголовок
+func newLogScanner(r io.Reader) *logScanner {
+	lines := bufio.NewScanner(r)
+	lines.Buffer(make([]byte, 0, 64*1024), maxLogLine)
+	s := &logScanner{lines: lines}
+	s.Scan()
+	return s
+}
+
+// nextLine возвращает следующую физическую строку лога без \r\n
+func (s *logScanner) nextLine() ([]byte, bool) {
+	if s.pending != nil {
+		line := s.pending
+		s.pending = nil
+		return line, true
+	}
+	if !s.lines.Scan() {
+		return nil, false
+	}
+	return bytes.TrimSuffix(s.lines.Bytes(), []byte{'\r'}), true
+}
+
+// Scan переходит к следующей записи
+func (s *logScanner) Scan() bool {
+	line, ok := s.nextLine()
+	if !ok {
+		return false
+	}
+	if !hasOpenQuote(line) {
+		s.record = line
+		return true
+	}
+
+	s.buf = append(s.buf[:0], line...)
+	for hasOpenQuote(s.buf) {
+		next, ok := s.nextLine()
+		if !ok {
+			break
+		}
+		// Незакрытая кавычка в испорченной строке не должна поглотить
+		// следующие записи: строка с отметкой времени начинает новую
+		if isRecordStart(next) {
+			s.pending = append([]byte(nil), next...)
+			break
+		}
+		s.buf = append(append(s.buf, '\n'), next...)
+	}
+	s.record = s.buf
+	return true
+}
+
+// Bytes возвращает текущую запись; данные действительны до следующего Scan
+func (s *logScanner) Bytes() []byte { return s.record }
+
+// Text возвращает копию текущей записи
+func (s *logScanner) Text() string { return string(s.record) }
+
+// Err возвращает ошибку чтения лога
+func (s *logScanner) Err() error { return s.lines.Err() }
+
+// readLogRows читает все записи лога (для вывода полной истории)
+func readLogRows(r io.Reader) ([]IPRecord, error) {
+	scanner := newLogScanner(r)
+	var rows []IPRecord
+	for scanner.Scan() {
+		if row, ok := parseLogLine(scanner.Text()); ok {
+			rows = append(rows, row)
+		}
+	}
+	return rows, scanner.Err()
+}
+
+// findMatches потоково собирает записи лога с данным ip, не загружая лог целиком
+func findMatches(r io.Reader, ip string) ([]IPRecord, error) {
+	scanner := newLogScanner(r)
+	needle := []byte("\t" + ip + "\t")
+
+	var matches []IPRecord
+	for scanner.Scan() {
+		// Дешёвый поиск подстроки отсекает строки без ip до их разбора
+		if !bytes.Contains(scanner.Bytes(), needle) {
+			continue
+		}
+		if row, ok := parseLogLine(scanner.Text()); ok && row.IP == ip {
+			matches = append(matches, row)
+		}
+	}
+	return matches, scanner.Err()
+}
+
+// getIndexPath возвращает путь к индексу встречавшихся IP (файл рядом с логом,
+// по одному уникальному IP на строку). Суффикс дописывается к полному имени
+// лога, чтобы путь индекса никогда не совпал с самим логом.
+func getIndexPath(logPath string) string {
+	return logPath + ".ips"
+}
+
+// lookupIP проверяет по индексу, встречался ли ip в логе, и при collect
+// собирает его прошлые записи. Если индекса нет или он описывает другое
+// состояние лога (лог изменён, подменён или восстановлен из копии), индекс
+// перестраивается по логу, и совпадения собираются в том же проходе.
+// Последним значением возвращается заголовок индекса, если индекс на диске
+// проверен или успешно перезаписан, иначе пустая строка: дописывать в такой
+// индекс нельзя.
+func lookupIP(f *os.File, indexPath, ip string, collect bool) (bool, []IPRecord, string, error) {
+	// Состояние лога фиксируем до чтения: запись, дописанная другим запуском
+	// во время чтения, даст несовпадение заголовка и перестройку, а не индекс
+	// без её IP
+	logInfo, err := f.Stat()
+	if err != nil {
+		return false, nil, "", err
+	}
+	header := indexHeader(logInfo)
+
+	if found, err := searchIndex(indexPath, header, ip); err == nil {
+		if !found || !collect {
+			return found, nil, header, nil
+		}
+		if _, err := f.Seek(0, io.SeekStart); err != nil {
+			return found, nil, header, err
+		}
+		matches, err := findMatches(f, ip)
+		return found, matches, header, err
+	}
+
+	if _, err := f.Seek(0, io.SeekStart); err != nil {
+		return false, nil, "", err
+	}
+	// Индекс сохраняется, только если лог прочитан целиком: частичный индекс
+	// выглядел бы актуальным и давал неверные ответы
+	ips, matches, err := collectLogIPs(f, ip, collect)
+	if err != nil {
+		return false, nil, "", err
+	}
+
+	var sb strings.Builder
+	sb.WriteString(header)
+	found := false
+	for _, v := range ips {
+		sb.WriteString(v)
+		sb.WriteByte('\n')
+		if v == ip {
+			found = true
+		}
+	}
+	if err := writeIndex(indexPath, sb.String()); err != nil {
+		header = ""
+	}
+	return found, matches, header, nil
+}
+
+// writeIndex заменяет индекс целиком: содержимое пишется во временный файл
+// рядом и переименовывается поверх, чтобы параллельный запуск не прочитал
+// недописанный индекс
+func writeIndex(indexPath, content string) error {
+	tmp, err := os.CreateTemp(filepath.Dir(indexPath), filepath.Base(indexPath)+".tmp*")
+	if err != nil {
+		return err
+	}
+	_ = tmp.Chmod(0644)
+	if _, err := tmp.WriteString(content); err != nil {
+		tmp.Close()
+		os.Remove(tmp.Name())
+		return err
+	}
+	if err := tmp.Close(); err != nil {
+		os.Remove(tmp.Name())
+		return err
+	}
+	if err := os.Rename(tmp.Name(), indexPath); err != nil {
+		os.Remove(tmp.Name())
+		return err
+	}
+	return nil
+}
+
+// indexHeader возвращает первую строку индекса: размер и время изменения лога,
+// по состоянию которого индекс построен. Строка фиксированной длины, чтобы её
+// можно было перезаписать на месте после сохранения.
+func indexHeader(logInfo os.FileInfo) string {
+	return fmt.Sprintf("#ipwatch-index size=%020d mtime=%020d\n", logInfo.Size(), logInfo.ModTime().UnixNano())
+}
+
+// errStaleIndex — индекс построен не по текущему состоянию лога
+var errStaleIndex = errors.New("ip index is stale")
+
+// indexTailSize — сколько байт с конца индекса проверяется в первую очередь
+const indexTailSize = 64 * 1024
+
+// searchIndex ищет ip в индексе поиском подстроки, без построчного разбора.
+// Если заголовок индекса не совпадает с header, возвращает errStaleIndex.
+// Новые IP дописываются в конец, поэтому сначала проверяется хвост файла, и
+// только при промахе — остальная его часть.
+func searchIndex(indexPath, header, ip string) (bool, error) {
+	file, err := os.Open(indexPath)
+	if err != nil {
+		return false, err
+	}
+	defer file.Close()
+
+	got := make([]byte, len(header))
+	if _, err := file.ReadAt(got, 0); err != nil || string(got) != header {
+		return false, errStaleIndex
+	}
+
+	info, err := file.Stat()
+	if err != nil {
+		return false, err
+	}
+	size := info.Size()
+	needle := []byte("\n" + ip + "\n")
+
+	// Хвост может начинаться с середины строки, поэтому в нём ищем только
+	// IP, которому предшествует перевод строки (у первого IP это перевод
+	// строки заголовка)
+	offset := size - indexTailSize
+	if offset < 0 {
+		offset = 0
+	}
+	tail := make([]byte, size-offset)
+	if _, err := file.ReadAt(tail, offset); err != nil && err != io.EOF {
+		return false, err
+	}
+	if bytes.Contains(tail, needle) {
+		return true, nil
+	}
+
+	// Голова с перекрытием, чтобы не пропустить строку на границе хвоста
+	headSize := offset + int64(len(needle)) - 1
+	if headSize > size {
+		headSize = size
+	}
+	head := make([]byte, headSize)
+	if _, err := file.ReadAt(head, 0); err != nil && err != io.EOF {
+		return false, err
+	}
+	return bytes.Contains(head, needle), nil
+}
+
+// collectLogIPs возвращает уникальные IP из лога в порядке первого появления
+// и, при collect, записи с данным ip. Строки читаются как байты: в string
+// копируются только новые IP и совпавшие записи.
+func collectLogIPs(r io.Reader, ip string, collect bool) ([]string, []IPRecord, error) {
+	scanner := newLogScanner(r)
+
+	seen := make(map[string]bool)
+	var ips []string
+	var matches []IPRecord
+	for scanner.Scan() {
+		line := scanner.Bytes()
+		field, ok := logLineIP(line)
+		if !ok {
+			continue
+		}
+		if !seen[string(field)] {
+			v := string(field)
+			seen[v] = true
+			ips = append(ips, v)
+		}
+		if collect && string(field) == ip {
+			if row, ok := parseLogLine(string(line)); ok {
+				matches = append(matches, row)
 			}
 		}
 	}
-	return map[string]interface{}{"query": ip, "isp": "N/A"}
+	if err := scanner.Err(); err != nil {
+		return nil, nil, err
+	}
+	return ips, matches, nil
+}
+
+// logLineIP возвращает поле IP строки лога без её полного разбора (записи
+// с полями в кавычках разбираются целиком)
+func logLineIP(line []byte) ([]byte, bool) {
+	if bytes.IndexByte(line, '"') >= 0 {
+		row, ok := parseLogLine(string(line))
+		return []byte(row.IP), ok
+	}
+	if bytes.Count(line, []byte{'\t'}) < len(logHeaders)-1 {
+		return nil, false
+	}
+	rest := line[bytes.IndexByte(line, '\t')+1:]
+	return rest[:bytes.IndexByte(rest, '\t')], true
+}
+
+// updateIndex дописывает новый IP в индекс после сохранения в лог и
+// перезаписывает заголовок индекса новым состоянием лога. covered — заголовок,
+// которому индекс должен соответствовать до сохранения (пустой, если индекс не
+// проверен). Если на диске другой заголовок, индекс удаляется: иначе
+// устаревший индекс получил бы актуальный заголовок. Отсутствующий индекс
+// будет перестроен при следующем запуске.
+func updateIndex(f *os.File, indexPath, covered, ip string, isNew bool) {
+	if covered == "" || !indexHeaderIs(indexPath, covered) {
+		_ = os.Remove(indexPath)
+		return
+	}
+	logInfo, err := f.Stat()
+	if err != nil {
+		_ = os.Remove(indexPath)
+		return
+	}
+	if isNew {
+		file, err := os.OpenFile(indexPath, os.O_WRONLY|os.O_APPEND, 0644)
+		if err != nil {
+			_ = os.Remove(indexPath)
+			return
+		}
+		_, err = file.WriteString(ip + "\n")
+		file.Close()
+		if err != nil {
+			_ = os.Remove(indexPath)
+			return
+		}
+	}
+
+	// WriteAt недоступен для файла, открытого с O_APPEND
+	file, err := os.OpenFile(indexPath, os.O_WRONLY, 0644)
+	if err != nil {
+		return
+	}
+	defer file.Close()
+	_, _ = file.WriteAt([]byte(indexHeader(logInfo)), 0)
 }
 
-// renderTable генерирует таблицу с ограничением разделителя по ширине
-func renderTable(headers []string, rows [][]string) string {
-	if len(headers) == 0 {
-		return ""
+// indexHeaderIs проверяет, что индекс на диске начинается с заголовка header
+func indexHeaderIs(indexPath, header string) bool {
+	file, err := os.Open(indexPath)
+	if err != nil {
+		return false
 	}
+	defer file.Close()
+	got := make([]byte, len(header))
+	_, err = file.ReadAt(got, 0)
+	return err == nil && string(got) == header
+}
 
-	// Считаем ширины колонок по контенту
-	colWidths := make([]int, len(headers))
-	for i, h := range headers {
-		colWidths[i] = len(h)
+// logHeaders — колонки лога, они же заголовки всех таблиц вывода
+var logHeaders = [...]string{"Timestamp", "IP Address", "ISP", "Comment"}
+
+// logHeaderWidths — ширины заголовков выравниваемых колонок. Последняя
+// колонка (Comment) выводится как есть, поэтому её ширина не нужна.
+var logHeaderWidths = func() (w [len(logHeaders) - 1]int) {
+	for i := range w {
+		w[i] = len(logHeaders[i])
 	}
+	return w
+}()
+
+// renderTable генерирует таблицу записей лога с ограничением разделителя по
+// ширине. Число колонок фиксировано (IPRecord), проверки длины строк не нужны.
+func renderTable(rows []IPRecord) string {
+	// Считаем ширины колонок по контенту за один проход, начиная с заранее
+	// посчитанных ширин заголовков
+	colWidths := logHeaderWidths
 	for _, row := range rows {
-		for i, val := range row {
-			if i < len(colWidths) && len(val) > colWidths[i] {
-				colWidths[i] = len(val)
+		cols := row.fields()
+		for i := range colWidths {
+			if len(cols[i]) > colWidths[i] {
+				colWidths[i] = len(cols[i])
 			}
 		}
 	}
 
 	// Функция для сборки одной строки таблицы
-	buildRow := func(cols []string) string {
-		var lineParts []string
+	buildRow := func(cols [len(logHeaders)]string) string {
+		var line strings.Builder
 		for i, val := range cols {
+			if i > 0 {
+				line.WriteString(" | ")
+			}
+			line.WriteString(val)
 			if i < len(cols)-1 {
-				// Первые три колонки выравниваем пробелами по ширине
-				lineParts = append(lineParts, fmt.Sprintf("%-*s", colWidths[i], val))
-			} else {
-				// Последнюю колонку (Comment) выводим как есть
-				lineParts = append(lineParts, val)
+				// Первые три колонки добиваем пробелами до ширины (как %-*s,
+				// по числу символов); последнюю (Comment) выводим как есть
+				if pad := colWidths[i] - utf8.RuneCountInString(val); pad > 0 {
+					line.WriteString(strings.Repeat(" ", pad))
+				}
 			}
 		}
-		return strings.Join(lineParts, " | ")
+		return line.String()
 	}
 
-	var renderedRows []string
-	
-	// Рендерим заголовок и строки данных
-	headerLine := buildRow(headers)
+	// Рендерим заголовок и строки данных; их число известно заранее
+	renderedRows := make([]string, 0, len(rows)+1)
+	headerLine := buildRow(logHeaders)
 	renderedRows = append(renderedRows, headerLine)
 
 	maxLineLen := len(headerLine)
 	for _, row := range rows {
-		line := buildRow(row)
+		line := buildRow(row.fields())
 		renderedRows = append(renderedRows, line)
 		if len(line) > maxLineLen {
 			maxLineLen = len(line)
@@ -290,13 +794,21 @@ func renderTable(headers []string, rows [][]string) string {
 
 	sep := strings.Repeat("-", maxLineLen)
 
+	// Собираем таблицу в один буфер без промежуточных конкатенаций строк,
+	// сразу выделив место под все строки и три разделителя
 	var sb strings.Builder
-	sb.WriteString(sep + "\n")
-	sb.WriteString(renderedRows[0] + "\n") // Заголовок
-	sb.WriteString(sep + "\n")
-	
-	for _, r := range renderedRows[1:] {   // Строки
-		sb.WriteString(r + "\n")
+	size := 3 * (len(sep) + 1)
+	for _, r := range renderedRows {
+		size += len(r) + 1
+	}
+	sb.Grow(size)
+	for _, r := range []string{sep, renderedRows[0], sep} { // Заголовок
+		sb.WriteString(r)
+		sb.WriteByte('\n')
+	}
+	for _, r := range renderedRows[1:] { // Строки
+		sb.WriteString(r)
+		sb.WriteByte('\n')
 	}
 	sb.WriteString(sep)
 
@@ -327,63 +839,63 @@ func main() {
 		return
 	}
 
+	shouldSave := *saveFlag || *commentFlag != ""
+
 	fileExisted := true
 	if _, err := os.Stat(logPath); os.IsNotExist(err) {
 		fileExisted = false
-		_ = os.MkdirAll(filepath.Dir(logPath), 0755)
 	}
 
-	f, err := os.OpenFile(logPath, os.O_CREATE|os.O_RDWR|os.O_APPEND, 0644)
+	// Создаём лог и открываем его на запись только при сохранении; для
+	// просмотра истории и проверки IP достаточно открыть его на чтение
+	var f *os.File
+	var err error
+	if shouldSave {
+		if !fileExisted {
+			_ = os.MkdirAll(filepath.Dir(logPath), 0755)
+		}
+		f, err = os.OpenFile(logPath, os.O_CREATE|os.O_RDWR|os.O_APPEND, 0644)
+	} else if fileExisted {
+		f, err = os.Open(logPath)
+	}
 	if err != nil {
 		fmt.Fprintf(os.Stderr, "Error opening log file: %v\n", err)
 		os.Exit(1)
 	}
-	defer f.Close()
-
-	writer := csv.NewWriter(f)
-	writer.Comma = '\t'
-
-	if !fileExisted {
-		_ = writer.Write([]string{"Timestamp", "IP Address", "ISP", "Comment"})
-		writer.Flush()
-	}
-
-	rf, err := os.Open(logPath)
-	var allRows [][]string
-	if err == nil {
-		reader := csv.NewReader(rf)
-		reader.Comma = '\t'
-		records, _ := reader.ReadAll()
-		if len(records) > 1 {
-			allRows = records[1:]
-		}
-		rf.Close()
+	if f != nil {
+		defer f.Close()
 	}
 
 	if *listFlag {
+		var allRows []IPRecord
+		if fileExisted {
+			if allRows, err = readLogRows(f); err != nil {
+				fmt.Fprintf(os.Stderr, "Error reading log file: %v\n", err)
+				os.Exit(1)
+			}
+		}
 		if len(allRows) == 0 {
 			fmt.Fprintln(os.Stderr, "No IP records found.")
 			return
 		}
-		fmt.Fprintln(os.Stderr, renderTable([]string{"Timestamp", "IP Address", "ISP", "Comment"}, allRows))
+		fmt.Fprintln(os.Stderr, renderTable(allRows))
 		return
 	}
 
-	shouldSave := *saveFlag || *commentFlag != ""
-	var raw map[string]interface{}
+	var info ipInfo
 
 	if *customIPFlag != "" {
 		if shouldSave {
-			raw = fetchIPForCustom(*customIPFlag)
+			info = fetchIPForCustom(*customIPFlag)
 		} else {
-			raw = map[string]interface{}{"query": *customIPFlag, "isp": "Manual"}
+			info = ipInfo{IP: *customIPFlag, ISP: "Manual"}
 		}
 	} else {
 		var err error
 		if *tableFlag || shouldSave {
-			raw, err = fetchIPFull()
+			info, err = fetchIPFull()
 		} else {
-			raw, err = fetchIPFast()
+			info, err = fetchIPFast()
 		}
 		if err != nil {
 			fmt.Fprintf(os.Stderr, "Error: %v\n", err)
@@ -391,9 +903,8 @@ func main() {
 		}
 	}
 
-	rawISP, _ := raw["isp"].(string)
-	isp := normalizeISP(rawISP, cfg.ISPNormalization)
-	ip, _ := raw["query"].(string)
+	isp := normalizeISP(info.ISP, cfg.ISPNormalization)
+	ip := info.IP
 	comment := *commentFlag
 	if comment == "" {
 		comment = "N/A"
@@ -406,16 +917,20 @@ func main() {
 		Comment:   comment,
 	}
 
-	isNew := true
-	var matches [][]string
-	for _, row := range allRows {
-		if len(row) >= 2 && row[1] == record.IP {
-			isNew = false
-			if *tableFlag {
-				matches = append(matches, row)
-			}
+	// Новизну IP определяем по индексу, сам лог читаем (через уже открытый
+	// дескриптор: O_APPEND влияет только на запись) лишь ради таблицы совпадений
+	indexPath := getIndexPath(logPath)
+	found := false
+	var matches []IPRecord
+	var covered string
+	if f != nil {
+		found, matches, covered, err = lookupIP(f, indexPath, record.IP, *tableFlag)
+		if err != nil {
+			fmt.Fprintf(os.Stderr, "Error reading log file: %v\n", err)
+			os.Exit(1)
 		}
 	}
+	isNew := !found
 
 	color := colorWarning
 	status := "used before"
@@ -425,24 +940,37 @@ func main() {
 	}
 
 	if *tableFlag {
-		headers := []string{"Timestamp", "IP Address", "ISP", "Comment"}
-		rows := [][]string{{record.Timestamp, record.IP, record.ISP, record.Comment}}
-		tableOutput := renderTable(headers, rows)
+		rows := []IPRecord{record}
+		tableOutput := renderTable(rows)
 		tableOutput = strings.ReplaceAll(tableOutput, record.IP, wrapColor(record.IP, color))
-		fmt.Fprintln(os.Stderr, tableOutput)
 
+		// Обе таблицы выводим одной записью в stderr
+		var out strings.Builder
+		out.WriteString(tableOutput + "\n")
 		if len(matches) > 0 {
-			fmt.Fprintln(os.Stderr, "\n⚠️  IP matches found:")
-			fmt.Fprintln(os.Stderr, renderTable(headers, matches))
+			out.WriteString("\n⚠️  IP matches found:\n")
+			out.WriteString(renderTable(matches) + "\n")
 		}
+		fmt.Fprint(os.Stderr, out.String())
 	} else {
 		fmt.Fprintf(os.Stderr, "IP: %s (%s)\n", wrapColor(record.IP, color), status)
 	}
 
 	if shouldSave {
-		err := writer.Write([]string{record.Timestamp, record.IP, record.ISP, record.Comment})
+		// Заголовок нового лога и запись уходят одним системным вызовом write
+		line := formatLogLine(record.Timestamp, record.IP, record.ISP, record.Comment)
+		before, err := f.Stat()
+		if err == nil && before.Size() == 0 {
+			line = formatLogLine(logHeaders[:]...) + line
+		}
+		// Индекс можно дописать, только если он описывает лог в том виде,
+		// в каком тот был прямо перед этой записью
+		if err != nil || indexHeader(before) != covered {
+			covered = ""
+		}
+		_, err = f.WriteString(line)
 		if err == nil {
-			writer.Flush()
+			updateIndex(f, indexPath, covered, record.IP, isNew)
 			fmt.Fprintln(os.Stderr, "✅ IP saved to log.")
 		}
 	}
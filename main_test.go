@@ -0,0 +1,159 @@
+package main
+
+import (
+	"encoding/csv"
+	"fmt"
+	"os"
+	"path/filepath"
+	"strings"
+	"testing"
+)
+
+// baselineLog возвращает лог в том виде, в каком его писали прежние версии
+// через encoding/csv с табуляцией в качестве разделителя
+func baselineLog(t *testing.T, useCRLF bool, rows ...IPRecord) string {
+	t.Helper()
+	var sb strings.Builder
+	w := csv.NewWriter(&sb)
+	w.Comma = '\t'
+	w.UseCRLF = useCRLF
+	_ = w.Write(logHeaders[:])
+	for _, r := range rows {
+		f := r.fields()
+		_ = w.Write(f[:])
+	}
+	w.Flush()
+	if err := w.Error(); err != nil {
+		t.Fatal(err)
+	}
+	return sb.String()
+}
+
+func rec(comment string) IPRecord {
+	return IPRecord{Timestamp: "2024-01-01 10:00", IP: "1.1.1.1", ISP: "Provider", Comment: comment}
+}
+
+// logLine возвращает запись в текущем формате лога
+func logLine(r IPRecord) string {
+	f := r.fields()
+	return formatLogLine(f[:]...)
+}
+
+func TestReadLogRows(t *testing.T) {
+	next := IPRecord{Timestamp: "2024-01-02 11:00", IP: "2.2.2.2", ISP: "Other", Comment: "N/A"}
+	tests := []struct {
+		name string
+		log  string
+		want []IPRecord
+	}{
+		{"escaped quotes", baselineLog(t, false, rec(`say "hi"`), next), []IPRecord{rec(`say "hi"`), next}},
+		{"quote at start", baselineLog(t, false, rec(`"quoted" text`), next), []IPRecord{rec(`"quoted" text`), next}},
+		{"tab in quotes", baselineLog(t, false, rec("a\tb \"q\""), next), []IPRecord{rec("a\tb \"q\""), next}},
+		{"newline in quotes", baselineLog(t, false, rec("line1\nline2\n\nline4"), next), []IPRecord{rec("line1\nline2\n\nline4"), next}},
+		{"leading space", baselineLog(t, false, rec(" lead"), next), []IPRecord{rec(" lead"), next}},
+		{"quoted isp", baselineLog(t, false, IPRecord{"2024-01-01 10:00", "1.1.1.1", "\"Q\"\tISP", "N/A"}, next),
+			[]IPRecord{{"2024-01-01 10:00", "1.1.1.1", "\"Q\"\tISP", "N/A"}, next}},
+		{"crlf", baselineLog(t, true, rec("plain"), rec("multi\r\nline"), next), []IPRecord{rec("plain"), rec("multi\nline"), next}},
+		{"current format", formatLogLine(logHeaders[:]...) + logLine(rec(`"a" b`)) + logLine(next),
+			[]IPRecord{rec(`"a" b`), next}},
+		// Незакрытая кавычка не поглощает следующую запись
+		{"unterminated quote",
+			"Timestamp\tIP Address\tISP\tComment\n2024-01-01 10:00\t1.1.1.1\tProvider\t\"x\nstill x\n2024-01-02 11:00\t2.2.2.2\tOther\tN/A\n",
+			[]IPRecord{rec("\"x\nstill x"), next}},
+		{"incomplete row", "Timestamp\tIP Address\tISP\tComment\n2024-01-01 10:00\t1.1.1.1\n2024-01-02 11:00\t2.2.2.2\tOther\tN/A\n",
+			[]IPRecord{next}},
+	}
+	for _, tt := range tests {
+		t.Run(tt.name, func(t *testing.T) {
+			got, err := readLogRows(strings.NewReader(tt.log))
+			if err != nil {
+				t.Fatal(err)
+			}
+			if fmt.Sprintf("%q", got) != fmt.Sprintf("%q", tt.want) {
+				t.Errorf("readLogRows:\n got %q\nwant %q", got, tt.want)
+			}
+
+			ips, _, err := collectLogIPs(strings.NewReader(tt.log), "", false)
+			if err != nil {
+				t.Fatal(err)
+			}
+			var wantIPs []string
+			for _, r := range tt.want {
+				if len(wantIPs) == 0 || wantIPs[len(wantIPs)-1] != r.IP {
+					wantIPs = append(wantIPs, r.IP)
+				}
+			}
+			if strings.Join(ips, ",") != strings.Join(wantIPs, ",") {
+				t.Errorf("collectLogIPs = %q, want %q", ips, wantIPs)
+			}
+		})
+	}
+}
+
+func TestFormatLogLineRoundTrip(t *testing.T) {
+	for _, comment := range []string{`"start`, `"a" "b"`, `mid "q"`, ` lead`, "tab\there", "new\nline"} {
+		line := logLine(rec(comment))
+		got, ok := parseLogLine(strings.TrimSuffix(line, "\n"))
+		want := rec(logFieldReplacer.Replace(comment))
+		if !ok || got != want {
+			t.Errorf("comment %q: got %q, want %q", comment, got, want)
+		}
+	}
+}
+
+func TestSearchIndex(t *testing.T) {
+	dir := t.TempDir()
+	logPath := filepath.Join(dir, "log.csv")
+	if err := os.WriteFile(logPath, []byte("log"), 0644); err != nil {
+		t.Fatal(err)
+	}
+	logInfo, err := os.Stat(logPath)
+	if err != nil {
+		t.Fatal(err)
+	}
+	header := indexHeader(logInfo)
+
+	var sb strings.Builder
+	sb.WriteString(header)
+	starts := map[string]int{}
+	for i := 0; sb.Len() < 3*indexTailSize; i++ {
+		ip := fmt.Sprintf("10.%d.%d.%d", i/65536, i/256%256, i%256)
+		starts[ip] = sb.Len()
+		sb.WriteString(ip + "\n")
+	}
+	content := sb.String()
+	indexPath := filepath.Join(dir, "log.csv.ips")
+	if err := os.WriteFile(indexPath, []byte(content), 0644); err != nil {
+		t.Fatal(err)
+	}
+
+	// Строки вокруг начала хвоста: целиком в голове, на границе и в хвосте
+	offset := len(content) - indexTailSize
+	var boundary []string
+	for ip, start := range starts {
+		if start > offset-32 && start < offset+32 {
+			boundary = append(boundary, ip)
+		}
+	}
+	if len(boundary) == 0 {
+		t.Fatal("no index lines near the tail boundary")
+	}
+	first := strings.SplitN(content[len(header):], "\n", 2)[0]
+	last := content[strings.LastIndexByte(content[:len(content)-1], '\n')+1 : len(content)-1]
+	for _, ip := range append(boundary, first, last) {
+		if found, err := searchIndex(indexPath, header, ip); err != nil || !found {
+			t.Errorf("searchIndex(%q) = %v, %v; want true", ip, found, err)
+		}
+	}
+
+	// Префикс существующего IP и отсутствующий IP не находятся
+	for _, ip := range []string{"10.0.0", "10.0.0.1.1", "0.0.0.1", "192.168.0.1"} {
+		if found, err := searchIndex(indexPath, header, ip); err != nil || found {
+			t.Errorf("searchIndex(%q) = %v, %v; want false", ip, found, err)
+		}
+	}
+
+	if _, err := searchIndex(indexPath, strings.Replace(header, "size=", "size=1", 1)[:len(header)], first); err != errStaleIndex {
+		t.Errorf("stale header: err = %v, want errStaleIndex", err)
+	}
+}